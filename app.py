@@ -1,14 +1,34 @@
 import streamlit as st
-from docx import Document
-from docx.shared import RGBColor
-import google.generativeai as genai
+# python-docx, google-generativeai, fpdf2 e pypdf são importados dentro das funções que os
+# usam: o arranque da app (primeira página) não paga o import de gRPC/lxml/fontTools
+import numpy as np
 import pandas as pd
+from cache import LLMCache, cached_call
 import json
+import orjson
 import re
-from fpdf import FPDF
-import pypdf
+import ahocorasick
 import io
+import os
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fitz  # PyMuPDF (extração de texto em C, muito mais rápida)
+except ImportError:
+    fitz = None
+try:
+    import pypdfium2 as pdfium  # PDFium (motor do Chrome), alternativa rápida em C
+except ImportError:
+    pdfium = None
+import asyncio
+import datetime
+import random
+import threading
 import time
+import hashlib
+import sqlite3
+import zlib
+from functools import lru_cache
 
 # ==========================================
 # 1. BIBLIOTECA RJAIA (Base de Conhecimento)
@@ -25,153 +45,664 @@ RJAIA_LIBRARY = {
 # 2. FUNÇÕES DE LEITURA E PROCESSAMENTO
 # ==========================================
 
-def read_pdf_with_pages(file):
-    """Lê PDF e insere marcadores de página."""
+# Expressões regulares compiladas uma única vez
+_FENCE_RE = re.compile(r"```json\s*|```\s*$", re.MULTILINE)  # blocos markdown à volta do JSON
+_MARK_RE = re.compile(r'<<<.*?>>>')  # marcadores internos de página/parágrafo
+_PAGE_MARK_RE = re.compile(r'<<<PÁGINA (\d+)>>>')  # marcador de página (PDF)
+_WORD_RE = re.compile(r'\w+')  # palavras (SimHash dos blocos)
+_PAGE_LOC_RE = re.compile(r'p[áa]g\w*\.?\s*(\d+)', re.IGNORECASE)  # "Página 12", "pág. 12"
+_LEGISL_RE = re.compile(r'legisl', re.IGNORECASE)  # "Legislação", "Legislativo"
+
+def _fitz_page_texts(data):
+    """Iterador com o texto de cada página via PyMuPDF."""
+    # Abre já o documento para que um PDF inválido falhe aqui (e não a meio da leitura)
+    doc = fitz.open(stream=data, filetype="pdf")
+    return _iter_fitz_pages(doc)
+
+def _iter_fitz_pages(doc):
+    # Leitura em série: o PyMuPDF não suporta várias threads (mesmo com um Document por thread)
+    # e mantém o GIL durante a extração, por isso um pool não acelera e arrisca falhas
+    try:
+        for page in doc:
+            yield page.get_text("text")
+    finally:
+        doc.close()
+
+def _pypdf_page_texts(data):
+    """Iterador com o texto de cada página via pypdf (alternativa se o PyMuPDF não estiver disponível)."""
+    import pypdf
+    # strict=False: tolera PDFs ligeiramente inválidos em vez de abortar (e salta validações extra)
+    reader = pypdf.PdfReader(io.BytesIO(data), strict=False)
+    for page in reader.pages:
+        yield page.extract_text()
+
+def _pdfium_page_texts(data):
+    """Iterador com o texto de cada página via pypdfium2."""
+    pdf = pdfium.PdfDocument(data)
+    return _iter_pdfium_pages(pdf)
+
+def _iter_pdfium_pages(pdf):
+    try:
+        for page in pdf:
+            textpage = page.get_textpage()
+            # O PDFium devolve quebras "\r\n"; os outros leitores usam só "\n"
+            yield textpage.get_text_range().replace("\r\n", "\n").replace("\r", "\n")
+            textpage.close()
+            page.close()
+    finally:
+        pdf.close()
+
+# Leitores de PDF por ordem de preferência: (nome, disponível, função de páginas)
+PDF_BACKENDS = [
+    ("pymupdf", fitz is not None, _fitz_page_texts),
+    ("pypdfium2", pdfium is not None, _pdfium_page_texts),
+    ("pypdf", True, _pypdf_page_texts),
+]
+
+def available_pdf_backends():
+    """Nomes dos leitores de PDF instalados."""
+    return [name for name, available, _ in PDF_BACKENDS if available]
+
+def iter_pdf_pages(data, backend=None):
+    """
+    Gera o texto de cada página já com o marcador, sem montar o documento inteiro.
+    Sem `backend` fixo, passa ao leitor seguinte se um falhar ou não extrair texto nenhum.
+    """
+    candidates = [(name, fn) for name, available, fn in PDF_BACKENDS if available and backend in (None, name)]
+    if not candidates:
+        raise ValueError(f"Leitor de PDF indisponível: {backend}")
+    
+    for n, (name, page_texts) in enumerate(candidates):
+        last = n == len(candidates) - 1
+        found_text = False
+        try:
+            for i, text in enumerate(page_texts(data)):
+                if text:
+                    found_text = True
+                    yield f"\n<<<PÁGINA {i+1}>>>\n{text}"
+        except Exception as e:
+            # Depois de já ter entregue páginas não é possível trocar de leitor
+            if found_text or last:
+                raise
+            print(f"{name} falhou, a tentar o leitor seguinte: {e}")
+            continue
+        if found_text:
+            return
+
+# Devolvido em vez do texto quando o PDF é digitalizado (só imagens)
+SCAN_SENTINEL = "__SCAN_DETECTED__"
+SCAN_SAMPLE_PAGES = 2
+SCAN_MIN_CHARS = 20
+
+def scan_sample_pages(page_count):
+    """
+    Páginas a testar: as primeiras e ainda a do meio e a última. Capa e declaração assinada
+    digitalizadas seguidas de texto nativo são comuns nos PTF e não fazem do PDF um scan.
+    """
+    if page_count == 0:
+        return []
+    return sorted({*range(min(SCAN_SAMPLE_PAGES, page_count)), page_count // 2, page_count - 1})
+
+def _fitz_scan_sample(data):
+    doc = fitz.open(stream=data, filetype="pdf")
+    try:
+        pages = [doc.load_page(i) for i in scan_sample_pages(doc.page_count)]
+        return [(page.get_text("text"), len(page.get_images())) for page in pages]
+    finally:
+        doc.close()
+
+def _pdfium_scan_sample(data):
+    pdf = pdfium.PdfDocument(data)
     try:
-        reader = pypdf.PdfReader(file)
-        full_text = ""
-        for i, page in enumerate(reader.pages):
-            text = page.extract_text()
-            if text:
-                full_text += f"\n<<<PÁGINA {i+1}>>>\n{text}"
-        return full_text
+        samples = []
+        for i in scan_sample_pages(len(pdf)):
+            page = pdf[i]
+            textpage = page.get_textpage()
+            images = sum(1 for _ in page.get_objects(filter=(pdfium.raw.FPDF_PAGEOBJ_IMAGE,)))
+            samples.append((textpage.get_text_range(), images))
+            textpage.close()
+            page.close()
+        return samples
+    finally:
+        pdf.close()
+
+def _pypdf_scan_sample(data):
+    import pypdf
+    reader = pypdf.PdfReader(io.BytesIO(data), strict=False)
+    pages = reader.pages
+    return [(pages[i].extract_text(), len(pages[i].images)) for i in scan_sample_pages(len(pages))]
+
+# Amostra (texto, n.º de imagens) de algumas páginas, com o mesmo leitor da extração
+SCAN_PROBES = {"pymupdf": _fitz_scan_sample, "pypdfium2": _pdfium_scan_sample, "pypdf": _pypdf_scan_sample}
+
+def looks_scanned(data, backend=None):
+    """Verdadeiro se as páginas da amostra só tiverem imagens (sem texto), sem ler o resto do PDF."""
+    name = backend or available_pdf_backends()[0]
+    try:
+        samples = SCAN_PROBES[name](data)
+    except Exception as e:
+        # Na dúvida não é digitalizado: a extração segue pelos leitores (e pelas alternativas)
+        print(f"Verificação de PDF digitalizado falhou ({name}): {e}")
+        return False
+    # Capas em imagem não chegam: todas as páginas da amostra (incluindo meio e fim) têm de estar sem texto
+    return bool(samples) and all(len((text or "").strip()) < SCAN_MIN_CHARS and images for text, images in samples)
+
+def read_pdf_with_pages(file, backend=None):
+    """Lê PDF (bytes ou ficheiro) e insere marcadores de página (SCAN_SENTINEL se for digitalizado)."""
+    try:
+        data = file if isinstance(file, (bytes, bytearray)) else file.read()
+        if looks_scanned(data, backend):
+            return SCAN_SENTINEL
+        return "".join(iter_pdf_pages(data, backend))
     except Exception as e:
         return f"Erro PDF: {e}"
 
 def read_docx(file):
     """Lê Word e insere marcadores aproximados."""
+    from docx import Document
     doc = Document(file)
-    text = ""
+    parts = []
     for i, para in enumerate(doc.paragraphs):
         if para.text.strip():
             if i % 20 == 0:
-                text += f"\n<<<PARÁGRAFO APROX. {i}>>>\n"
-            text += f"{para.text}\n"
+                parts.append(f"\n<<<PARÁGRAFO APROX. {i}>>>\n")
+            parts.append(f"{para.text}\n")
+    return "".join(parts)
+
+# Muda quando a extração muda (marcadores, leitores), invalidando os textos guardados em disco
+EXTRACTION_VERSION = 1
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def extract_text(file_bytes, filename, pdf_backend=None):
+    """
+    Extrai o texto do ficheiro carregado (em cache pelo conteúdo, não repete em novas análises).
+    Além da cache em memória, o texto fica na cache em disco, que sobrevive a reinícios da app.
+    """
+    cache = get_llm_cache()
+    digest = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+    key = f"ext:{EXTRACTION_VERSION}:{digest}:{os.path.splitext(filename)[1].lower()}:{pdf_backend}"
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    
+    if filename.lower().endswith('.pdf'):
+        # Os bytes vão diretos para o leitor: sem BytesIO + read() a duplicar o ficheiro em memória
+        text = read_pdf_with_pages(file_bytes, pdf_backend)
+    else:
+        text = read_docx(io.BytesIO(file_bytes))
+    # Falhas de leitura não ficam guardadas
+    if cache is not None and not text.startswith("Erro PDF"):
+        cache.set(key, text)
     return text
 
+def _iter_lines(parts):
+    """Percorre as linhas de um texto (ou de uma sequência de pedaços) sem criar a lista completa."""
+    if isinstance(parts, str):
+        parts = (parts,)
+    pending = ""
+    for part in parts:
+        # str.find em vez de split: uma linha de cada vez, sem lista de linhas do texto inteiro
+        start = 0
+        end = part.find('\n')
+        while end != -1:
+            yield pending + part[start:end]
+            pending = ""
+            start = end + 1
+            end = part.find('\n', start)
+        # A última linha pode continuar no pedaço seguinte
+        pending += part[start:]
+    yield pending
+
+def iter_text_chunks(parts, max_chars=12000):
+    """Gera os blocos à medida que o texto é lido (aceita uma string ou um iterável de páginas)."""
+    # Lista + tamanho acumulado em vez de `+=` (evita copiar o bloco a cada linha)
+    buf, buflen = [], 0
+    last_marker = None
+    for para in _iter_lines(parts):
+        # Só fecha o bloco se já tiver conteúdo: um parágrafo enorme não gera blocos vazios
+        if buf and buflen + len(para) >= max_chars:
+            yield "".join(buf)
+            buf, buflen = [], 0
+            # Um bloco que começa a meio de uma página repete o marcador dessa página,
+            # para o modelo saber onde está (e indicar a 'localizacao' certa)
+            if last_marker and not _MARK_RE.fullmatch(para):
+                buf += [last_marker, "\n"]
+                buflen += len(last_marker) + 1
+        buf += [para, "\n"]
+        buflen += len(para) + 1
+        if para.startswith("<<<") and _MARK_RE.fullmatch(para):
+            last_marker = para
+    if buf:
+        yield "".join(buf)
+
 def split_text_into_chunks(text, max_chars=12000):
     """Divide o texto em blocos para não exceder limites da API."""
-    chunks = []
-    current_chunk = ""
-    paragraphs = text.split('\n')
+    return list(iter_text_chunks(text, max_chars))
+
+# Distância de Hamming máxima (em 64 bits) para considerar dois blocos quase iguais
+SIMHASH_MAX_DISTANCE = 3
+
+def simhash(text):
+    """SimHash de 64 bits sobre sequências de 3 palavras (ignora os marcadores de página)."""
+    words = _WORD_RE.findall(_MARK_RE.sub('', text).lower())
+    shingles = Counter(zip(words, words[1:], words[2:]))
+    if not shingles:
+        return 0
+    # Os 64 bits de todos os hashes numa matriz (uma linha por sequência): a soma ponderada
+    # por bit é feita pelo numpy, em vez de um ciclo Python de 64 passos por sequência
+    digests = b"".join(hashlib.blake2b(" ".join(shingle).encode(), digest_size=8).digest() for shingle in shingles)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8), axis=1)
+    counts = np.fromiter(shingles.values(), dtype=np.int64, count=len(shingles))
+    weights = counts @ (2 * bits.astype(np.int64) - 1)
+    return int.from_bytes(np.packbits(weights > 0).tobytes(), 'big')
+
+def find_duplicate_chunks(chunks):
+    """Para cada bloco, devolve o índice de um bloco anterior quase igual (ou None se for novo)."""
+    seen = []
+    duplicate_of = []
+    for i, chunk in enumerate(chunks):
+        h = simhash(chunk)
+        original = next((j for h2, j in seen if (h ^ h2).bit_count() <= SIMHASH_MAX_DISTANCE), None)
+        duplicate_of.append(original)
+        if original is None:
+            seen.append((h, i))
+    return duplicate_of
+
+def first_page(chunk):
+    """Número da primeira página marcada no bloco (None se não houver marcador)."""
+    match = _PAGE_MARK_RE.search(chunk)
+    return int(match.group(1)) if match else None
+
+def shift_page_locations(items, shift):
+    """Copia os erros de um bloco repetido, deslocando a página da 'localizacao'."""
+    def move(match):
+        prefix = match.group(0)[:match.start(1) - match.start(0)]
+        return f"{prefix}{int(match.group(1)) + shift}"
     
-    for para in paragraphs:
-        if len(current_chunk) + len(para) < max_chars:
-            current_chunk += para + "\n"
-        else:
-            chunks.append(current_chunk)
-            current_chunk = para + "\n"
-    if current_chunk:
-        chunks.append(current_chunk)
-    return chunks
+    shifted = []
+    for item in items:
+        item = dict(item)
+        if shift and isinstance(item.get('localizacao'), str):
+            item['localizacao'] = _PAGE_LOC_RE.sub(move, item['localizacao'], count=1)
+        shifted.append(item)
+    return shifted
+
+# Blocos sem texto corrido (índices, cabeçalhos, numeração) não vão ao modelo
+MIN_CHUNK_CHARS = 200
+MIN_ALNUM_RATIO = 0.3
+_FILLER_RE = re.compile(r'[\s\d.\-·•]+')  # só números, pontos e traços
+_TOC_LEADERS = ('....', '…', '____')  # pontos/traços de índice: "2.1 Enquadramento ........ 12"
+_PROSE_RE = re.compile(r'[^\W\d_]+(?:[\s,;:]+[^\W\d_]+){3,}')  # 4+ palavras seguidas (frase corrida)
+
+def _is_toc_line(line):
+    """Linha de índice (título, pontos/traços e número da página), testada em tempo linear."""
+    # Sem regex: '.+?' seguido de uma sequência de pontos faz backtracking quadrático em linhas
+    # longas de '....' ou '____' (comuns nos campos de formulário dos PTF)
+    title = line.rstrip().rstrip('0123456789')
+    if len(title) == len(line.rstrip()):
+        return False
+    title = title.rstrip()
+    return title.endswith(_TOC_LEADERS) and bool(title.rstrip('._…').strip())
+
+def worth_analyzing(chunk):
+    """
+    Falso só para blocos que são claramente índice/numeração (sem texto para rever).
+    Um bloco feito sobretudo de frases é sempre analisado, por curto que seja.
+    """
+    text = _MARK_RE.sub('', chunk).strip()
+    if not text or _FILLER_RE.fullmatch(text):
+        return False
+    lines = [line.strip() for line in text.split('\n') if line.strip()]
+    toc_flags = [_is_toc_line(line) for line in lines]
+    prose_chars = sum(
+        len(match.group(0)) for line, is_toc in zip(lines, toc_flags) if not is_toc
+        for match in _PROSE_RE.finditer(line)
+    )
+    if prose_chars >= len(text) / 2:
+        return True
+    if sum(toc_flags) >= 0.8 * len(lines):
+        return False
+    if sum(c.isalnum() for c in text) / len(text) < MIN_ALNUM_RATIO:
+        return False
+    # O tamanho só conta para blocos curtos sem nenhuma frase
+    return len(text) >= MIN_CHUNK_CHARS or prose_chars > 0
+
+_JSON_DECODER = json.JSONDecoder()
 
 def repair_json(json_str):
-    """Tenta consertar JSON quebrado (comum em respostas longas de LLMs)."""
-    json_str = json_str.strip()
-    # Remove formatação markdown se existir
-    json_str = re.sub(r"```json\s*|```\s*$", "", json_str).strip()
+    """Recupera os objetos completos de uma lista JSON truncada (comum em respostas longas de LLMs)."""
+    items = []
+    i = json_str.find('[') + 1
+    if i == 0:
+        return items
+    n = len(json_str)
+    while i < n:
+        # Salta espaços e vírgulas até ao próximo item
+        while i < n and json_str[i] in ' \t\r\n,':
+            i += 1
+        if i >= n or json_str[i] == ']':
+            break
+        try:
+            # Lê um item de cada vez a partir de i; pára no primeiro que esteja incompleto
+            obj, i = _JSON_DECODER.raw_decode(json_str, i)
+        except json.JSONDecodeError:
+            break
+        items.append(obj)
+    return items
+
+def repair_json_object(json_str):
+    """Recupera os pares chave/valor completos de um objeto JSON truncado."""
+    data = {}
+    i = json_str.find('{') + 1
+    if i == 0:
+        return data
+    n = len(json_str)
+    while i < n:
+        while i < n and json_str[i] in ' \t\r\n,':
+            i += 1
+        if i >= n or json_str[i] == '}':
+            break
+        try:
+            key, i = _JSON_DECODER.raw_decode(json_str, i)
+            while i < n and json_str[i] in ' \t\r\n:':
+                i += 1
+            value, i = _JSON_DECODER.raw_decode(json_str, i)
+        except json.JSONDecodeError:
+            break
+        data[key] = value
+    return data
+
+def load_json_response(raw_resp, repair=repair_json):
+    """Lê o JSON da resposta; se vier cortado, `repair` aproveita as partes completas."""
+    try:
+        # Caso normal (response_mime_type JSON): a resposta já é JSON válido
+        return orjson.loads(raw_resp)
+    except orjson.JSONDecodeError:
+        # Remove formatação markdown se existir
+        cleaned = raw_resp.strip()
+        if "```" in cleaned:
+            cleaned = _FENCE_RE.sub("", cleaned).strip()
+        try:
+            return orjson.loads(cleaned)
+        except orjson.JSONDecodeError:
+            # JSON cortado: aproveita os itens completos sem voltar a ler tudo
+            return repair(cleaned)
+
+def parse_response(raw_resp):
+    """Converte a resposta do modelo numa lista de erros."""
+    data = load_json_response(raw_resp)
     
-    if not json_str.endswith(']'):
-        json_str = json_str.rstrip(',').rstrip() 
-        if json_str.count('"') % 2 != 0: json_str += '"'
-        if json_str.count('{') > json_str.count('}'): json_str += '}'
-        json_str += ']'
-    return json_str
+    # Normalização (garantir lista)
+    if isinstance(data, dict):
+        # {"erros": [...]}: o modelo às vezes embrulha a lista num objeto
+        first = next(iter(data.values()), [])
+        data = first if isinstance(first, list) else [data]
+    return data if isinstance(data, list) else []
 
 # ==========================================
 # 3. GERAÇÃO DE RELATÓRIOS (PDF e WORD)
 # ==========================================
 
-class PDFReport(FPDF):
-    def header(self):
-        self.set_font('Arial', 'B', 12)
-        self.cell(0, 10, 'Relatorio Auditoria PTF - RJAIA', 0, 1, 'C')
-        self.ln(5)
-    def footer(self):
-        self.set_y(-15)
-        self.set_font('Arial', 'I', 8)
-        self.cell(0, 10, f'Pag. {self.page_no()}', 0, 0, 'C')
+# Fonte Unicode para o relatório PDF (acentos sem perdas); sem ela usa-se Arial em latin-1
+PDF_FONT_DIR = os.environ.get("PTF_FONT_DIR", "/usr/share/fonts/truetype/dejavu")
+PDF_FONT_FILES = {"": "DejaVuSans.ttf", "B": "DejaVuSans-Bold.ttf", "I": "DejaVuSans-Oblique.ttf"}
+# Estilos obrigatórios; o itálico (rodapé) usa a fonte normal se faltar (o fonts-dejavu-core não traz Oblique)
+PDF_FONT_REQUIRED = ("", "B")
+
+# Caracteres frequentes em texto do Word/PDF que não existem em latin-1 (fonte Arial do FPDF)
+_LATIN1_SAFE = str.maketrans({
+    "\u2018": "'", "\u2019": "'", "\u201a": "'", "\u201b": "'",
+    "\u201c": '"', "\u201d": '"', "\u201e": '"',
+    "\u2013": "-", "\u2014": "-", "\u2011": "-", "\u2212": "-",
+    "\u2026": "...", "\u2022": "\u00b7", "\u20ac": "EUR", "\u2009": " ", "\u202f": " ",
+})
+
+@lru_cache(maxsize=1)
+def get_pdf_report_class():
+    """Classe do relatório PDF, criada na primeira utilização (o fpdf2 só é importado aqui)."""
+    from fpdf import FPDF, XPos, YPos
+    
+    class PDFReport(FPDF):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.base_font = 'Arial'
+            font_paths = {style: os.path.join(PDF_FONT_DIR, name) for style, name in PDF_FONT_FILES.items()}
+            if all(os.path.exists(font_paths[style]) for style in PDF_FONT_REQUIRED):
+                for style, path in font_paths.items():
+                    self.add_font('DejaVu', style, path if os.path.exists(path) else font_paths[""])
+                self.base_font = 'DejaVu'
+    
+        @property
+        def unicode(self):
+            return self.base_font != 'Arial'
+    
+        def header(self):
+            self.set_font(self.base_font, 'B', 12)
+            self.cell(0, 10, 'Relatorio Auditoria PTF - RJAIA', align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+            self.ln(5)
+        def footer(self):
+            self.set_y(-15)
+            self.set_font(self.base_font, 'I', 8)
+            self.cell(0, 10, f'Pag. {self.page_no()}', align='C')
+    
+    return PDFReport
 
 def create_pdf_audit(df):
     """Gera o PDF com a lista de erros."""
-    pdf = PDFReport()
+    from fpdf import XPos, YPos
+    pdf = get_pdf_report_class()()
+    pdf.set_compression(True)
     pdf.add_page()
     pdf.set_auto_page_break(auto=True, margin=15)
-    def safe(txt): return str(txt).encode('latin-1', 'replace').decode('latin-1')
     
-    for index, row in df.iterrows():
-        pdf.set_font('Arial', 'B', 10)
-        # Proteção contra Nulos
-        loc = safe(row.get('localizacao', '-') or '-')
-        cat = safe(row.get('categoria', 'Geral') or 'Geral')
-        
-        pdf.cell(0, 6, f"Local: {loc} | Tipo: {cat}", 0, 1)
+    def column(name, default):
+        """Coluna inteira como lista de strings já seguras (sem criar uma Series por linha)."""
+        if name not in df:
+            return [default] * len(df)
+        # Proteção contra Nulos (None, NaN ou vazio)
+        values = [str(v) if v is not None and v == v and v != '' else default for v in df[name].tolist()]
+        if pdf.unicode or not values:
+            return values
+        # Sem fonte Unicode: uma só conversão latin-1 para a coluna inteira (aspas/travessões
+        # tipográficos passam a equivalentes latin-1 em vez de '?')
+        def to_latin1(txt): return txt.translate(_LATIN1_SAFE).encode('latin-1', 'replace').decode('latin-1')
+        converted = to_latin1("\x00".join(values)).split("\x00")
+        # Um NUL dentro do próprio texto desalinharia as linhas: nesse caso converte valor a valor
+        return converted if len(converted) == len(values) else [to_latin1(v) for v in values]
+    
+    locs = column('localizacao', '-')
+    cats = column('categoria', 'Geral')
+    origs = column('texto_detetado', '')
+    sugs = column('sugestao', '')
+    
+    for loc, cat, orig_txt, sug_txt in zip(locs, cats, origs, sugs):
+        pdf.set_font(pdf.base_font, 'B', 10)
+        pdf.cell(0, 6, f"Local: {loc} | Tipo: {cat}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         
-        pdf.set_font('Arial', '', 9)
-        orig_txt = safe(row.get('texto_detetado', '') or '')
-        pdf.multi_cell(0, 5, f"Orig: {orig_txt}")
+        pdf.set_font(pdf.base_font, '', 9)
+        pdf.multi_cell(0, 5, f"Orig: {orig_txt}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         
         pdf.set_text_color(200, 0, 0)
-        sug_txt = safe(row.get('sugestao', '') or '')
-        pdf.multi_cell(0, 5, f"Sug: {sug_txt}")
+        pdf.multi_cell(0, 5, f"Sug: {sug_txt}", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
         pdf.set_text_color(0, 0, 0)
         
         pdf.ln(2)
         pdf.line(10, pdf.get_y(), 200, pdf.get_y())
         pdf.ln(2)
-    return pdf.output(dest='S').encode('latin-1')
+    # O fpdf2 devolve logo bytes (bytearray), sem reconversão de str para latin-1
+    return bytes(pdf.output())
+
+def _prepare_corrections(bads, goods, locs):
+    """
+    Filtra os erros uma única vez antes da reconstrução: descarta trechos curtos
+    e repetidos (o modelo devolve muitas vezes o mesmo erro em blocos diferentes).
+    Recebe as colunas já extraídas do DataFrame; devolve tuplos (errado, sugestão, localização).
+    """
+    corrections = []
+    seen = set()
+    for bad, good, loc in zip(bads, goods, locs):
+        # Garante que é string, mesmo que venha None/NaN do JSON
+        bad = str(bad or '').strip() if bad == bad else ''
+        good = str(good or '').strip() if good == good else ''
+        loc = str(loc or '') if loc == loc else ''
+        
+        # Só considera se o erro tiver mais de 4 caracteres (evita substituir letras soltas)
+        if len(bad) <= 4 or (bad, loc) in seen:
+            continue
+        seen.add((bad, loc))
+        corrections.append((bad, good, loc))
+    return corrections
+
+# Com poucos trechos, procurar com str.find sai mais barato do que construir um autómato
+AUTOMATON_MIN_PATTERNS = 8
+
+def _build_corrections_matcher(corrections):
+    """
+    Prepara a pesquisa dos trechos errados (None se não houver): lista de pares
+    (errado, sugestão) para poucos trechos, autómato Aho-Corasick para muitos.
+    """
+    if not corrections:
+        return None
+    if len(corrections) < AUTOMATON_MIN_PATTERNS:
+        return [(bad, good) for bad, good, _loc in corrections]
+    automaton = ahocorasick.Automaton()
+    for bad, good, _loc in corrections:
+        automaton.add_word(bad, (bad, good))
+    automaton.make_automaton()
+    return automaton
+
+def _find_corrections(paragraph, matcher):
+    """Procura todos os erros numa só passagem e devolve (início, fim, sugestão) sem sobreposições."""
+    hits = []
+    if isinstance(matcher, list):
+        # Percorre o parágrafo por índices (str.find), sem split nem regex
+        for bad, good in matcher:
+            i = paragraph.find(bad)
+            while i != -1:
+                hits.append((i, i + len(bad), good))
+                i = paragraph.find(bad, i + len(bad))
+    else:
+        for end, (bad, good) in matcher.iter(paragraph):
+            hits.append((end - len(bad) + 1, end + 1, good))
+    
+    # Da esquerda para a direita; na mesma posição ganha o trecho mais longo
+    # (apanha frases completas antes de palavras soltas)
+    hits.sort(key=lambda hit: (hit[0], hit[0] - hit[1]))
+    spans = []
+    cursor = 0
+    for start, end, good in hits:
+        if start >= cursor:
+            spans.append((start, end, good))
+            cursor = end
+    return spans
+
+@lru_cache(maxsize=1)
+def get_docx_xml():
+    """OxmlElement e qn do python-docx, importados uma única vez (e não a cada <w:r>)."""
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+    return OxmlElement, qn
+
+def _xml_run(text, corrected=False):
+    """Cria um <w:r> diretamente no XML (sem passar pelos objetos Run do python-docx)."""
+    OxmlElement, qn = get_docx_xml()
+    run = OxmlElement('w:r')
+    if corrected:
+        # Texto corrigido: negrito e vermelho
+        rpr = OxmlElement('w:rPr')
+        rpr.append(OxmlElement('w:b'))
+        color = OxmlElement('w:color')
+        color.set(qn('w:val'), 'FF0000')
+        rpr.append(color)
+        run.append(rpr)
+    t = OxmlElement('w:t')
+    t.set(qn('xml:space'), 'preserve')
+    t.text = text
+    run.append(t)
+    return run
+
+def _group_errors_by_page(corrections, doc_pages):
+    """Separa os erros com página conhecida (localizacao) dos restantes, que valem para todo o documento."""
+    errors_by_page = defaultdict(list)
+    unlocated = []
+    for correction in corrections:
+        match = _PAGE_LOC_RE.search(correction[2])
+        page = int(match.group(1)) if match else None
+        if page in doc_pages:
+            errors_by_page[page].append(correction)
+        else:
+            unlocated.append(correction)
+    return errors_by_page, unlocated
 
 def generate_corrected_docx(original_text, corrections_df):
     """
     Recria o documento Word e aplica correções a vermelho.
     Versão BLINDADA contra erros de NoneType.
     """
+    from docx import Document
+    OxmlElement, _ = get_docx_xml()
     doc = Document()
     doc.add_heading('PTF - Versão Corrigida (IA)', 0)
     
-    # Remover marcadores internos (<<<PÁGINA X>>>) para o texto final limpo
-    clean_text = re.sub(r'<<<.*?>>>', '', original_text)
-    paragraphs = clean_text.split('\n')
+    # Agrupa os erros pela página indicada pelo modelo: cada parágrafo só é
+    # comparado com os erros da sua página (e vizinhas) + os erros sem página
+    def column(name):
+        # Lista simples da coluna (evita um dict por linha do to_dict('records'))
+        return corrections_df[name].tolist() if name in corrections_df else [None] * len(corrections_df)
+    corrections = _prepare_corrections(column('texto_detetado'), column('sugestao'), column('localizacao'))
+    doc_pages = {int(n) for n in _PAGE_MARK_RE.findall(original_text)}
+    errors_by_page, unlocated = _group_errors_by_page(corrections, doc_pages)
     
-    # Converter DF para lista de dicionários
-    errors = corrections_df.to_dict('records')
+    matchers = {}
+    def matcher_for(page):
+        if page not in matchers:
+            local = []
+            if page is not None:
+                # Tolerância de uma página para trechos que atravessam a quebra de página
+                for near in (page - 1, page, page + 1):
+                    local.extend(errors_by_page.get(near, ()))
+            matchers[page] = _build_corrections_matcher(local + unlocated)
+        return matchers[page]
 
-    for paragraph in paragraphs:
+    body = doc.element.body
+    sect_pr = body.sectPr
+    paragraphs = []
+    
+    current_page = None
+    for line in _iter_lines(original_text):
+        marker = _PAGE_MARK_RE.fullmatch(line.strip())
+        if marker:
+            current_page = int(marker.group(1))
+            continue
+        
+        # Remover marcadores internos (<<<PARÁGRAFO X>>>) para o texto final limpo
+        paragraph = _MARK_RE.sub('', line)
         if not paragraph.strip(): continue
-        p = doc.add_paragraph()
+        p = OxmlElement('w:p')
         
-        matches = []
-        for error in errors:
-            # --- CORREÇÃO DO ERRO ---
-            # Garante que é string, mesmo que venha None do JSON
-            bad = str(error.get('texto_detetado', '') or '').strip()
-            good = str(error.get('sugestao', '') or '').strip()
-            
-            # Só considera se o erro tiver mais de 4 caracteres (evita substituir letras soltas)
-            # e se realmente existir no parágrafo
-            if len(bad) > 4 and bad in paragraph:
-                matches.append((bad, good))
+        matcher = matcher_for(current_page)
+        spans = _find_corrections(paragraph, matcher) if matcher is not None else []
         
-        if not matches:
-            p.add_run(paragraph)
-        else:
-            # Se houver erros, aplica a correção no primeiro encontrado (estratégia simples)
-            # Ordena por tamanho para garantir que apanha frases completas antes de palavras
-            matches.sort(key=lambda x: len(x[0]), reverse=True)
-            bad, good = matches[0]
-            
-            parts = paragraph.split(bad)
-            if len(parts) > 1:
-                p.add_run(parts[0]) # Texto antes
-                
-                run_err = p.add_run(good) # Texto corrigido
-                run_err.font.color.rgb = RGBColor(255, 0, 0) # Vermelho
-                run_err.bold = True
-                
-                # Texto depois (junta o resto caso o erro apareça mais que uma vez ou o split divida mais)
-                p.add_run("".join(parts[1:]))
-            else:
-                p.add_run(paragraph)
+        # Alterna texto original (preto) e sugestões (vermelho) numa só passagem
+        cursor = 0
+        for start, end, good in spans:
+            if start > cursor:
+                p.append(_xml_run(paragraph[cursor:start]))
+            p.append(_xml_run(good, corrected=True))
+            cursor = end
+        
+        if cursor < len(paragraph):
+            p.append(_xml_run(paragraph[cursor:]))
+        
+        paragraphs.append(p)
+    
+    # Inserção única no corpo; os parágrafos têm de ficar antes do <w:sectPr> final
+    if sect_pr is not None:
+        pos = body.index(sect_pr)
+        body[pos:pos] = paragraphs
+    else:
+        body.extend(paragraphs)
     
     buffer = io.BytesIO()
     doc.save(buffer)
@@ -182,13 +713,84 @@ def generate_corrected_docx(original_text, corrections_df):
 # 4. LÓGICA AI (Dinâmica)
 # ==========================================
 
-def analyze_chunk(chunk_text, api_key, model_name, library_context):
-    """Envia um pedaço do texto para o modelo selecionado."""
-    genai.configure(api_key=api_key)
-    
-    system_prompt = f"""
+# Pedidos em simultâneo à API (substitui a pausa fixa entre blocos); ajustável na barra lateral
+MAX_CONCURRENCY = 5
+# Tentativas extra quando a API devolve rate-limit (429)
+MAX_RETRIES = 3
+# Limites por omissão do plano gratuito do Gemini Flash (ajustáveis na barra lateral)
+DEFAULT_RPM = 15
+DEFAULT_TPM = 1_000_000
+# Blocos agrupados num só pedido (ajustável na barra lateral; 1 = um pedido por bloco)
+CHUNKS_PER_REQUEST = 3
+# Máximo de caracteres por pedido agrupado. O limite vem do tamanho da
+# resposta (max_output_tokens), não do contexto de entrada do modelo.
+BATCH_MAX_CHARS = 36000
+
+class RateLimiter:
+    """
+    Token bucket proativo para pedidos/minuto (RPM) e tokens/minuto (TPM).
+    As capacidades recarregam com o tempo decorrido; partilhado entre threads.
+    """
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_request_capacity = requests_per_minute
+        self.available_token_capacity = tokens_per_minute
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        self.available_request_capacity = min(
+            self.requests_per_minute,
+            self.available_request_capacity + self.requests_per_minute * elapsed / 60
+        )
+        self.available_token_capacity = min(
+            self.tokens_per_minute,
+            self.available_token_capacity + self.tokens_per_minute * elapsed / 60
+        )
+
+    def acquire(self, tokens):
+        """Bloqueia até haver capacidade para um pedido com `tokens` tokens (estimados)."""
+        # Um pedido maior do que o limite por minuto nunca caberia no bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= tokens
+                    return
+                # Espera o tempo necessário para recarregar o que falta
+                wait = max(
+                    (1 - self.available_request_capacity) * 60 / self.requests_per_minute,
+                    (tokens - self.available_token_capacity) * 60 / self.tokens_per_minute,
+                    0.05
+                )
+            time.sleep(wait)
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter(api_key, requests_per_minute, tokens_per_minute):
+    """Um limitador por chave (os limites da API são por projeto, não por sessão)."""
+    return RateLimiter(requests_per_minute, tokens_per_minute)
+
+def estimate_tokens(text):
+    """Estimativa grosseira de tokens (~4 caracteres por token)."""
+    return len(text) // 4 + 1
+
+@lru_cache(maxsize=1)
+def get_library_context():
+    """Biblioteca RJAIA como lista markdown (menos tokens do que JSON: sem chavetas nem aspas)."""
+    return "\n".join(f"- {topic}: {reference}" for topic, reference in RJAIA_LIBRARY.items())
+
+def build_system_prompt(library_context):
+    """Monta as instruções de sistema com a biblioteca legal."""
+    return f"""
     És um Especialista em RJAIA (Avaliação de Impacte Ambiental).
-    BIBLIOTECA LEGAL: {library_context}
+    BIBLIOTECA LEGAL:
+{library_context}
     
     TAREFA: Analisa o texto fornecido e gera um JSON com erros.
     1. Gralhas e Ortografia.
@@ -206,20 +808,255 @@ def analyze_chunk(chunk_text, api_key, model_name, library_context):
       }}
     ]
     """
-    
-    config = {
-        "temperature": 0.1, 
-        "response_mime_type": "application/json",
-        "max_output_tokens": 8192
-    }
-    
+
+# Constante da sessão: a biblioteca e o prompt são montados uma única vez
+SYSTEM_PROMPT = build_system_prompt(get_library_context())
+# Muda sozinho quando o prompt (ou a biblioteca) muda, invalidando a cache de respostas
+PROMPT_VERSION = hashlib.sha256(SYSTEM_PROMPT.encode()).hexdigest()[:12]
+
+# Campos de cada erro no JSON pedido ao modelo (colunas da tabela de resultados)
+RESULT_COLUMNS = ("localizacao", "categoria", "gravidade", "texto_detetado", "sugestao")
+
+GENERATION_CONFIG = {
+    "temperature": 0.1, 
+    "response_mime_type": "application/json",
+    "max_output_tokens": 8192
+}
+# Teto da resposta proporcional ao pedido (a lista de erros nunca é maior do que o texto)
+MIN_OUTPUT_TOKENS = 1024
+# Limite por pedido: um worker pendurado não prende um lugar do semáforo indefinidamente.
+# Os pedidos agrupados (vários blocos, até 8k tokens de saída) precisam de mais do que 30 s.
+REQUEST_TIMEOUT = 90
+
+@lru_cache(maxsize=1)
+def get_request_retry():
+    """
+    Erros transitórios do servidor (500, 503, 504) repetidos pela própria biblioteca, com orçamento limitado.
+    Sem os 429: o rate-limit é tratado só em generate(), que volta a passar pelo limitador.
+    """
+    from google.api_core import exceptions as google_exceptions
+    from google.api_core import retry as google_retry
+    return google_retry.Retry(
+        initial=1.0, maximum=8.0, multiplier=2.0, timeout=REQUEST_TIMEOUT,
+        predicate=google_retry.if_exception_type(
+            google_exceptions.InternalServerError,
+            google_exceptions.ServiceUnavailable,
+            google_exceptions.GatewayTimeout,
+        )
+    )
+
+def output_token_cap(prompt):
+    """max_output_tokens ajustado ao tamanho do pedido."""
+    return min(GENERATION_CONFIG["max_output_tokens"], max(MIN_OUTPUT_TOKENS, len(prompt) // 3))
+
+def key_fingerprint(api_key):
+    """Identificador curto da chave para usar em caches (nunca a chave em claro)."""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+# genai.configure altera o estado global do módulo, partilhado por todas as sessões
+_GENAI_CONFIG_LOCK = threading.Lock()
+
+@st.cache_data(show_spinner=False, ttl=600)
+def list_gemini_models(api_key_hash, _api_key):
+    """Lista os modelos que geram texto ('generateContent'), mais recentes primeiro."""
+    import google.generativeai as genai
+    # A listagem usa o cliente global: configurar e listar sem outra sessão trocar a chave pelo meio
+    with _GENAI_CONFIG_LOCK:
+        genai.configure(api_key=_api_key)
+        return sorted(
+            (m.name for m in genai.list_models() if 'generateContent' in m.supported_generation_methods),
+            reverse=True
+        )
+
+# Cache de contexto do Gemini: o prompt de sistema fica guardado no servidor e não é
+# reprocessado a cada pedido. A API só aceita caches a partir de um mínimo de tokens.
+CONTEXT_CACHE_MIN_TOKENS = 4096
+CONTEXT_CACHE_TTL = datetime.timedelta(hours=1)
+
+# O modelo é recriado antes de a cache de contexto expirar no servidor
+@st.cache_resource(show_spinner=False, ttl=CONTEXT_CACHE_TTL - datetime.timedelta(minutes=5))
+def get_model(api_key, model_name, prompt_version):
+    """Configura a API e cria o modelo uma única vez por (chave, modelo, prompt)."""
+    import google.generativeai as genai
+    from google.generativeai import caching
+    from google.generativeai import client as genai_client
+    # genai.configure é global ao processo e o GenerativeModel só obtém o cliente no primeiro
+    # pedido: o cliente desta chave fica associado já aqui, antes que outra sessão reconfigure
+    with _GENAI_CONFIG_LOCK:
+        genai.configure(api_key=api_key)
+        model = None
+        if estimate_tokens(SYSTEM_PROMPT) >= CONTEXT_CACHE_MIN_TOKENS:
+            try:
+                cached_content = caching.CachedContent.create(
+                    model=model_name,
+                    system_instruction=SYSTEM_PROMPT,
+                    ttl=CONTEXT_CACHE_TTL
+                )
+                model = genai.GenerativeModel.from_cached_content(cached_content, generation_config=GENERATION_CONFIG)
+            except Exception as e:
+                # Modelo sem suporte a cache de contexto: segue com o prompt normal
+                print(f"Cache de contexto indisponível para {model_name}: {e}")
+        if model is None:
+            model = genai.GenerativeModel(
+                model_name=model_name,
+                generation_config=GENERATION_CONFIG,
+                system_instruction=SYSTEM_PROMPT
+            )
+        model._client = genai_client.get_default_generative_client()
+    return model
+
+@st.cache_resource(show_spinner=False)
+def get_llm_cache():
+    """Cache em disco das respostas e dos textos extraídos (None se a pasta de cache não for gravável)."""
     try:
-        model = genai.GenerativeModel(model_name=model_name, generation_config=config, system_instruction=system_prompt)
-        response = model.generate_content(f"Analisa este trecho:\n{chunk_text}")
-        return response.text
+        return LLMCache()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Cache em disco indisponível: {e}")
+        return None
+
+@cached_call(get_llm_cache)
+def _call_model(prompt, model_name, prompt_version, api_key, limiter=None):
+    """Pedido efetivo à API; a resposta fica guardada em disco (SQLite) durante 7 dias."""
+    # Só os pedidos que vão mesmo à API (sem cache) gastam capacidade do limitador
+    if limiter is not None:
+        limiter.acquire(estimate_tokens(SYSTEM_PROMPT) + estimate_tokens(prompt))
+    model = get_model(api_key, model_name, prompt_version)
+    response = model.generate_content(
+        prompt,
+        generation_config={**GENERATION_CONFIG, "max_output_tokens": output_token_cap(prompt)},
+        request_options={"timeout": REQUEST_TIMEOUT, "retry": get_request_retry()}
+    )
+    return response.text
+
+# Respostas em memória limitadas a um número de entradas (as antigas ficam só em disco)
+RESPONSE_CACHE_MAX_ENTRIES = 512
+
+@st.cache_data(show_spinner=False, ttl=86400, max_entries=RESPONSE_CACHE_MAX_ENTRIES)
+def _cached_generate(prompt_hash, model_name, prompt_version, _prompt, _api_key, _limiter=None):
+    """
+    Chamada (síncrona) ao modelo, em cache pelo hash do pedido: primeiro em memória
+    (st.cache_data), depois em disco (cache.py), e só então na API.
+    O texto, a chave e o limitador começam por '_' para o Streamlit não os usar na chave da cache.
+    Exceções não ficam em cache, por isso falhas da API são sempre repetidas.
+    """
+    return _call_model(_prompt, model_name, prompt_version, _api_key, _limiter)
+
+async def generate(prompt, api_key, model_name, limiter=None):
+    """Envia um pedido ao modelo selecionado (assíncrono), repetindo em caso de rate-limit."""
+    from google.api_core import exceptions as google_exceptions
+    prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                return await asyncio.to_thread(
+                    _cached_generate, prompt_hash, model_name, PROMPT_VERSION, prompt, api_key, limiter
+                )
+            except google_exceptions.ResourceExhausted:
+                # Rate-limit (429): espera exponencial com jitter antes de tentar de novo
+                if attempt == MAX_RETRIES:
+                    raise
+                await asyncio.sleep(2 ** attempt + random.uniform(0, 1))
     except Exception as e:
         return f"ERROR: {str(e)}"
 
+async def analyze_chunk(chunk_text, api_key, model_name, limiter=None):
+    """Envia um pedaço do texto para o modelo selecionado (assíncrono)."""
+    return await generate(f"Analisa este trecho:\n{chunk_text}", api_key, model_name, limiter)
+
+def build_batch_prompt(chunks):
+    """Junta vários blocos num só pedido, com delimitadores numerados."""
+    keys = ", ".join(f'"{i}"' for i in range(len(chunks)))
+    parts = [
+        f"Analisa os seguintes {len(chunks)} trechos, delimitados por '### BLOCO i ###'.",
+        f"Devolve um objeto JSON cujas chaves são os números dos blocos ({keys}): "
+        "o valor da chave i é a lista de erros do bloco i (lista vazia se não houver erros)."
+    ]
+    for i, chunk in enumerate(chunks):
+        parts.append(f"### BLOCO {i} ###\n{chunk}")
+    return "\n".join(parts)
+
+def split_batch_response(raw_resp, n):
+    """
+    Separa a resposta de um pedido agrupado em n listas de erros, pela chave de cada bloco
+    (None nos blocos em falta: um bloco omitido não desloca os erros dos seguintes).
+    """
+    results = [None] * n
+    # Uma resposta truncada mantém os blocos completos (repair_json_object)
+    data = load_json_response(raw_resp, repair_json_object)
+    if not isinstance(data, dict):
+        return results
+    for key, items in data.items():
+        if str(key).isdigit() and int(key) < n and isinstance(items, list):
+            results[int(key)] = [error for error in items if isinstance(error, dict)]
+    return results
+
+async def analyze_batch(chunks, api_key, model_name, limiter=None):
+    """
+    Analisa vários blocos num único pedido; devolve uma lista de erros por bloco (ou None),
+    ou o texto "ERROR: ..." se o pedido falhar na API.
+    """
+    raw_resp = await generate(build_batch_prompt(chunks), api_key, model_name, limiter)
+    if raw_resp.startswith("ERROR"):
+        return raw_resp
+    # A interpretação corre numa thread: o ciclo de eventos continua a despachar pedidos
+    return await asyncio.to_thread(split_batch_response, raw_resp, len(chunks))
+
+async def _gather_bounded(jobs, max_concurrency, on_progress=None):
+    """Corre as corrotinas (funções sem argumentos) em paralelo, no máximo `max_concurrency` de cada vez."""
+    # Os pedidos correm em asyncio.to_thread: o executor por omissão (min(32, cpu+4) threads)
+    # limitaria o paralelismo abaixo do escolhido, por isso tem exatamente `max_concurrency` threads.
+    # O asyncio.run fecha-o no fim.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max_concurrency))
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async def bounded(job):
+        async with sem:
+            return await job()
+
+    tasks = []
+    for j, job in enumerate(jobs):
+        task = asyncio.ensure_future(bounded(job))
+        if on_progress:
+            # Indica ao chamador qual dos pedidos terminou
+            task.add_done_callback(lambda _task, j=j: on_progress(j))
+        tasks.append(task)
+    # A ordem dos resultados corresponde à ordem dos pedidos
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+async def analyze_all_chunks(chunks, api_key, model_name, on_progress=None, max_concurrency=MAX_CONCURRENCY, limiter=None):
+    """
+    Analisa todos os blocos em paralelo, um pedido por bloco.
+    Devolve, por bloco, a lista de erros já interpretada ou o texto "ERROR: ..." da API.
+    """
+    async def job(chunk):
+        raw_resp = await analyze_chunk(chunk, api_key, model_name, limiter)
+        if raw_resp.startswith("ERROR"):
+            return raw_resp
+        # JSON interpretado numa thread, em paralelo com a espera pelos outros pedidos
+        return await asyncio.to_thread(parse_response, raw_resp)
+
+    jobs = [lambda chunk=chunk: job(chunk) for chunk in chunks]
+    return await _gather_bounded(jobs, max_concurrency, on_progress)
+
+async def analyze_all_batches(batches, api_key, model_name, on_progress=None, max_concurrency=MAX_CONCURRENCY, limiter=None):
+    """Analisa grupos de blocos em paralelo, um pedido por grupo."""
+    jobs = [lambda batch=batch: analyze_batch(batch, api_key, model_name, limiter) for batch in batches]
+    return await _gather_bounded(jobs, max_concurrency, on_progress)
+
+def group_batches(indices, chunks, per_request, max_chars=BATCH_MAX_CHARS):
+    """Agrupa índices de blocos consecutivos até `per_request` blocos e `max_chars` caracteres por pedido."""
+    batches = []
+    current, size = [], 0
+    for i in indices:
+        if current and (len(current) >= per_request or size + len(chunks[i]) > max_chars):
+            batches.append(current)
+            current, size = [], 0
+        current.append(i)
+        size += len(chunks[i])
+    if current:
+        batches.append(current)
+    return batches
+
 # ==========================================
 # 5. INTERFACE (FRONTEND)
 # ==========================================
@@ -235,14 +1072,8 @@ api_key = st.sidebar.text_input("Google API Key", type="password")
 available_models = []
 if api_key:
     try:
-        genai.configure(api_key=api_key)
-        # Lista modelos e filtra apenas os que geram texto ('generateContent')
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                available_models.append(m.name)
-        
-        # Ordena para os mais recentes aparecerem primeiro
-        available_models.sort(reverse=True)
+        # Em cache: não repete o pedido à API a cada interação com a página
+        available_models = list_gemini_models(key_fingerprint(api_key), api_key)
         st.sidebar.success(f"Ligação OK! {len(available_models)} modelos detetados.")
         
     except Exception as e:
@@ -255,6 +1086,34 @@ if not available_models:
 # 3. Dropdown de Seleção
 selected_model = st.sidebar.selectbox("Escolha o Modelo", available_models, index=0)
 
+# 4. Paralelismo (chaves gratuitas têm limites de pedidos por minuto baixos)
+max_concurrency = st.sidebar.slider(
+    "Pedidos em paralelo", min_value=1, max_value=16, value=MAX_CONCURRENCY,
+    help="Número máximo de blocos enviados ao modelo ao mesmo tempo."
+)
+
+# 5. Agrupamento (menos pedidos por minuto; respostas maiores por pedido)
+chunks_per_request = st.sidebar.slider(
+    "Blocos por pedido", min_value=1, max_value=8, value=CHUNKS_PER_REQUEST,
+    help=f"Vários blocos seguem num só pedido (até {BATCH_MAX_CHARS} caracteres). 1 desativa o agrupamento."
+)
+
+# 6. Limites da API (evita erros 429 em vez de reagir a eles)
+rpm_limit = st.sidebar.number_input(
+    "Limite de pedidos/minuto (RPM)", min_value=1, value=DEFAULT_RPM,
+    help="Consulte os limites publicados para o modelo e o plano da sua chave."
+)
+tpm_limit = st.sidebar.number_input(
+    "Limite de tokens/minuto (TPM)", min_value=1000, value=DEFAULT_TPM, step=10000
+)
+
+# 7. Leitor de PDF (automático: o primeiro instalado que extraia texto)
+pdf_backend_choice = st.sidebar.selectbox(
+    "Leitor de PDF", ["Automático"] + available_pdf_backends(),
+    help="Fixe um leitor se o automático extrair o texto com problemas (p.ex. acentos ou fontes)."
+)
+pdf_backend = None if pdf_backend_choice == "Automático" else pdf_backend_choice
+
 
 st.title("🇵🇹 Analisador PTF - RJAIA (Beta)")
 st.markdown(f"**Status:** Modelo ativo `{selected_model}`")
@@ -265,16 +1124,10 @@ if uploaded_file and api_key:
     if st.button("🚀 Iniciar Análise", type="primary"):
         
         # --- Leitura ---
-        fname = uploaded_file.name.lower()
-        full_text = ""
-        
-        if fname.endswith('.pdf'):
-            full_text = read_pdf_with_pages(uploaded_file)
-        else:
-            full_text = read_docx(uploaded_file)
+        full_text = extract_text(uploaded_file.getvalue(), uploaded_file.name, pdf_backend)
             
         # Validação de Scan
-        if len(full_text) < 50:
+        if full_text == SCAN_SENTINEL or len(full_text) < 50:
             st.error("⚠️ Texto demasiado curto ou ilegível.")
             st.warning("Se carregou um PDF digitalizado (imagem), a App não consegue ler. Use um PDF nativo ou Word.")
             st.stop()
@@ -283,41 +1136,105 @@ if uploaded_file and api_key:
         chunks = split_text_into_chunks(full_text, max_chars=12000)
         st.info(f"Documento processado em {len(chunks)} blocos.")
         
+        # --- Blocos Repetidos ---
+        # Cabeçalhos/rodapés legais repetem-se: blocos quase iguais reutilizam a análise do original
+        duplicate_of = find_duplicate_chunks(chunks)
+        unique_idx = [i for i, original in enumerate(duplicate_of) if original is None]
+        n_dup = len(chunks) - len(unique_idx)
+        if n_dup:
+            st.info(f"{n_dup} blocos quase idênticos ({n_dup / len(chunks):.0%}) reutilizam a análise de blocos anteriores.")
+        
+        # Índices, numeração e afins ficam sem observações (sem pedido à API)
+        analyze_idx = [i for i in unique_idx if worth_analyzing(chunks[i])]
+        n_skip = len(unique_idx) - len(analyze_idx)
+        if n_skip:
+            st.info(f"{n_skip} blocos sem texto corrido (índices, numeração) não foram enviados ao modelo.")
+        
+        limiter = get_rate_limiter(api_key, int(rpm_limit), int(tpm_limit))
         progress_bar = st.progress(0)
-        master_results = []
-        library_json = json.dumps(RJAIA_LIBRARY, ensure_ascii=False)
+        # Resultados por coluna (uma lista por campo), em vez de um dict por erro
+        result_columns = {name: [] for name in RESULT_COLUMNS}
+        def add_results(items):
+            for item in items:
+                if isinstance(item, dict):
+                    for name, values in result_columns.items():
+                        values.append(item.get(name))
+        results_by_chunk = {}
+        failed_chunks = set()
+        
+        done_chunks = set()
+        def mark_done(indices):
+            done_chunks.update(indices)
+            progress_bar.progress(len(done_chunks) / len(analyze_idx))
+        
+        # --- Pedidos Agrupados (vários blocos por pedido) ---
+        batches = [b for b in group_batches(analyze_idx, chunks, chunks_per_request) if len(b) > 1]
+        if batches:
+            with st.spinner(f"A analisar {sum(map(len, batches))} blocos em {len(batches)} pedidos agrupados..."):
+                batch_results = asyncio.run(
+                    analyze_all_batches(
+                        [[chunks[i] for i in b] for b in batches], api_key, selected_model,
+                        on_progress=lambda j: mark_done(batches[j]),
+                        max_concurrency=max_concurrency, limiter=limiter
+                    )
+                )
+            for batch, results in zip(batches, batch_results):
+                if isinstance(results, Exception):
+                    continue
+                if isinstance(results, str):
+                    # Erro da API (p.ex. quota esgotada): reenviar bloco a bloco só multiplicava os pedidos
+                    st.warning(f"Erro na API (blocos {batch[0]+1}-{batch[-1]+1}): {results}")
+                    failed_chunks.update(batch)
+                    continue
+                for i, items in zip(batch, results):
+                    if items is not None:
+                        results_by_chunk[i] = items
+        
+        # Blocos isolados, ou sem resposta legível no pedido agrupado, seguem um a um
+        to_analyze = [i for i in analyze_idx if i not in results_by_chunk and i not in failed_chunks]
+        done_chunks.difference_update(to_analyze)
         
-        # --- Loop de Processamento ---
-        for i, chunk in enumerate(chunks):
-            # Mensagem de estado
-            with st.spinner(f"A analisar parte {i+1} de {len(chunks)}..."):
-                raw_resp = analyze_chunk(chunk, api_key, selected_model, library_json)
-                
-                if not raw_resp.startswith("ERROR"):
-                    try:
-                        # Limpeza
-                        cleaned = repair_json(raw_resp)
-                        data = json.loads(cleaned)
-                        
-                        # Normalização (garantir lista)
-                        if isinstance(data, dict): data = [data]
-                        if isinstance(data, list): master_results.extend(data)
-                    except Exception as e:
-                        # Log discreto se falhar um chunk, não para o processo
-                        print(f"Erro parse chunk {i}: {e}")
+        # --- Processamento Paralelo ---
+        if to_analyze:
+            with st.spinner(f"A analisar {len(to_analyze)} blocos em paralelo..."):
+                responses = asyncio.run(
+                    analyze_all_chunks(
+                        [chunks[i] for i in to_analyze], api_key, selected_model,
+                        on_progress=lambda j: mark_done([to_analyze[j]]),
+                        max_concurrency=max_concurrency, limiter=limiter
+                    )
+                )
+
+            for i, items in zip(to_analyze, responses):
+                if isinstance(items, list):
+                    results_by_chunk[i] = items
+                elif isinstance(items, Exception):
+                    # Log discreto se falhar um chunk, não para o processo
+                    print(f"Erro parse chunk {i}: {items}")
                 else:
-                    st.warning(f"Erro na API (bloco {i+1}): {raw_resp}")
-            
-            # Atualiza progresso
-            progress_bar.progress((i + 1) / len(chunks))
-            # Pausa curta para evitar rate-limit se usar chave gratuita
-            time.sleep(1) 
+                    st.warning(f"Erro na API (bloco {i+1}): {items}")
+        
+        # Junta os resultados pela ordem dos blocos
+        for i, original in enumerate(duplicate_of):
+            if original is None:
+                add_results(results_by_chunk.get(i, []))
+            else:
+                shift = (first_page(chunks[i]) or 0) - (first_page(chunks[original]) or 0)
+                add_results(shift_page_locations(results_by_chunk.get(original, []), shift))
             
         st.success("Análise completa!")
         
         # Guardar em Sessão (para não perder ao clicar nos downloads)
-        st.session_state['results'] = pd.DataFrame(master_results)
-        st.session_state['text_ref'] = full_text
+        df = pd.DataFrame(result_columns)
+        # Poucas categorias distintas: o dtype category guarda códigos inteiros em vez de strings
+        # (listas/objetos vindos do modelo passam a texto: não são "hashable" e o astype falharia)
+        for name in ('categoria', 'gravidade'):
+            df[name] = df[name].map(lambda v: v if v is None or isinstance(v, str) else str(v)).astype('category')
+        cat_counts = df['categoria'].value_counts().to_dict()
+        st.session_state['results'] = df
+        st.session_state['cat_counts'] = cat_counts
+        # O texto integral só é preciso para o Word: guarda-se comprimido entre reruns
+        st.session_state['text_ref_z'] = zlib.compress(full_text.encode(), 6)
 
 # --- Exibição de Resultados ---
 if 'results' in st.session_state:
@@ -329,7 +1246,9 @@ if 'results' in st.session_state:
         with col1:
             st.markdown("### Resumo")
             st.metric("Total de Observações", len(df))
-            st.metric("Erros Legais", len(df[df['categoria'].str.contains('Legisl', case=False, na=False)]))
+            # Contagens calculadas uma vez no fim da análise (não a cada rerun)
+            cat_counts = st.session_state.get('cat_counts', {})
+            st.metric("Erros Legais", sum(n for cat, n in cat_counts.items() if _LEGISL_RE.search(str(cat))))
             
             st.divider()
             st.markdown("### 📥 Downloads")
@@ -344,7 +1263,7 @@ if 'results' in st.session_state:
             )
             
             # Download Word
-            doc_out = generate_corrected_docx(st.session_state['text_ref'], df)
+            doc_out = generate_corrected_docx(zlib.decompress(st.session_state['text_ref_z']).decode(), df)
             st.download_button(
                 "📝 PTF com Correções (Word)", 
                 doc_out, 
@@ -0,0 +1,102 @@
+"""Cache persistente (SQLite) das respostas do modelo, partilhada entre sessões e reinícios da app."""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import closing
+from functools import wraps
+
+CACHE_DIR = os.environ.get("PTF_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ptf"))
+# Validade das respostas guardadas (7 dias)
+DEFAULT_TTL = 7 * 24 * 3600
+# Tamanho máximo (dados comprimidos) antes de apagar as entradas mais antigas
+DEFAULT_SIZE_LIMIT = 1 << 30
+# Intervalo entre limpezas (entradas expiradas e limite de tamanho) num servidor sempre ligado
+PURGE_INTERVAL = 3600
+
+def make_key(model_name, version, prompt):
+    """Chave determinística: modelo + versão do prompt/biblioteca + texto do pedido."""
+    return hashlib.sha256(f"{model_name}|{version}|{prompt}".encode()).hexdigest()
+
+class LLMCache:
+    """
+    Cache chave -> texto em SQLite, comprimido com zlib, com validade (TTL) e tamanho máximo.
+    Erros do SQLite (base bloqueada, disco cheio) não chegam ao chamador: a cache é só um atalho.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, size_limit=DEFAULT_SIZE_LIMIT):
+        self.path = path or os.path.join(CACHE_DIR, "llm_cache.sqlite")
+        self.ttl = ttl
+        self.size_limit = size_limit
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.lock, closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache(key TEXT PRIMARY KEY, value BLOB, ts INT)")
+            # Limpa as entradas expiradas ao abrir
+            self._purge(conn)
+
+    def _connect(self):
+        # Uma ligação por operação: o SQLite não partilha ligações entre threads
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _purge(self, conn):
+        """Apaga as entradas expiradas e, acima do tamanho máximo, as mais antigas."""
+        conn.execute("DELETE FROM cache WHERE ts < ?", (int(time.time()) - self.ttl,))
+        conn.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM ("
+            "SELECT key, SUM(length(value)) OVER (ORDER BY ts DESC, rowid DESC) AS total FROM cache"
+            ") WHERE total > ?)",
+            (self.size_limit,)
+        )
+        self.last_purge = time.time()
+
+    def get(self, key):
+        """Devolve o texto guardado (None se não existir, tiver expirado ou a cache falhar)."""
+        try:
+            with self.lock, closing(self._connect()) as conn:
+                row = conn.execute("SELECT value, ts FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[1] > self.ttl:
+                return None
+            return zlib.decompress(row[0]).decode()
+        except (sqlite3.Error, zlib.error) as e:
+            print(f"Cache em disco: leitura falhou ({e})")
+            return None
+
+    def set(self, key, value):
+        """Guarda o texto comprimido, substituindo uma entrada anterior (falhas são ignoradas)."""
+        blob = zlib.compress(value.encode())
+        try:
+            with self.lock, closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache(key, value, ts) VALUES (?, ?, ?)",
+                    (key, blob, int(time.time()))
+                )
+                # A instância vive enquanto o servidor estiver ligado: limpa de tempos a tempos
+                if time.time() - self.last_purge > PURGE_INTERVAL:
+                    self._purge(conn)
+        except sqlite3.Error as e:
+            print(f"Cache em disco: escrita falhou ({e})")
+
+def cached_call(get_cache):
+    """
+    Decorador para fn(prompt, model_name, version, *args) -> str.
+    `get_cache` é uma função sem argumentos que devolve o LLMCache (ou None para
+    desativar a cache), resolvida só na altura da chamada.
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(prompt, model_name, version, *args, **kwargs):
+            cache = get_cache()
+            if cache is None:
+                return fn(prompt, model_name, version, *args, **kwargs)
+            key = make_key(model_name, version, prompt)
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
+            result = fn(prompt, model_name, version, *args, **kwargs)
+            cache.set(key, result)
+            return result
+        return wrapper
+    return decorator